@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from typing import Optional, List
+from typing import Dict, Optional, List
 
 SEPARATOR_TOKEN = "<|endoftext|>"
 
@@ -35,6 +35,8 @@ class Config:
     name: str
     instructions: str
     example_conversations: List[Conversation]
+    moderation_values_for_blocked: Optional[Dict[str, float]] = None
+    moderation_values_for_flagged: Optional[Dict[str, float]] = None
 
 
 @dataclass(frozen=True)
@@ -43,11 +45,15 @@ class Prompt:
     examples: List[Conversation]
     convo: Conversation
 
-    def render(self):
+    def render_prefix(self):
         return f"\n{SEPARATOR_TOKEN}".join(
             [self.header.render()]
             + [Message("System", "Example conversations:").render()]
             + [conversation.render() for conversation in self.examples]
             + [Message("System", "Current conversation:").render()]
-            + [self.convo.render()],
+        )
+
+    def render(self):
+        return f"\n{SEPARATOR_TOKEN}".join(
+            [self.render_prefix(), self.convo.render()]
         )
@@ -2,22 +2,62 @@ from enum import Enum
 from dataclasses import dataclass
 import openai
 from src.moderation import moderate_message
-from typing import Optional, List
-from src.constants import (
-    BOT_INSTRUCTIONS,
-    BOT_NAME,
-    EXAMPLE_CONVOS,
-)
+from typing import Dict, Optional, List
 import discord
-from src.base import Message, Prompt, Conversation
+from src import settings
+from src.settings import Settings
+from src.base import Message, Prompt, Conversation, SEPARATOR_TOKEN
 from src.utils import split_into_shorter_messages, close_thread, logger
+from src.rest import scheduler, Priority
 from src.moderation import (
     send_moderation_flagged_message,
     send_moderation_blocked_message,
 )
 
-MY_BOT_NAME = BOT_NAME
-MY_BOT_EXAMPLE_CONVOS = EXAMPLE_CONVOS
+MY_BOT_NAME = settings.current().config.name
+
+# bot name -> rendered instructions and examples, the part of the prompt that is
+# the same for every request
+_prompt_prefix_cache: Dict[str, str] = {}
+
+
+def _invalidate_prompt_prefix(old: Settings, new: Settings):
+    if (
+        old.config.name != new.config.name
+        or old.config.instructions != new.config.instructions
+        or old.config.example_conversations != new.config.example_conversations
+    ):
+        _prompt_prefix_cache.clear()
+
+
+settings.add_reload_listener(_invalidate_prompt_prefix)
+
+
+def prompt_prefix() -> str:
+    prefix = _prompt_prefix_cache.get(MY_BOT_NAME)
+    if prefix is None:
+        config = settings.current().config
+        # examples are written with the config name, swap in our discord name
+        examples = [
+            Conversation(
+                messages=[
+                    Message(user=MY_BOT_NAME, text=m.text)
+                    if m.user == config.name
+                    else m
+                    for m in c.messages
+                ]
+            )
+            for c in config.example_conversations
+        ]
+        prefix = Prompt(
+            header=Message(
+                "System", f"Instructions for {MY_BOT_NAME}: {config.instructions}"
+            ),
+            examples=examples,
+            convo=Conversation([]),
+        ).render_prefix()
+        _prompt_prefix_cache[MY_BOT_NAME] = prefix
+    return prefix
 
 
 class CompletionResult(Enum):
@@ -40,14 +80,8 @@ async def generate_completion_response(
     messages: List[Message], user: str
 ) -> CompletionData:
     try:
-        prompt = Prompt(
-            header=Message(
-                "System", f"Instructions for {MY_BOT_NAME}: {BOT_INSTRUCTIONS}"
-            ),
-            examples=MY_BOT_EXAMPLE_CONVOS,
-            convo=Conversation(messages + [Message(MY_BOT_NAME)]),
-        )
-        rendered = prompt.render()
+        convo = Conversation(messages + [Message(MY_BOT_NAME)])
+        rendered = f"\n{SEPARATOR_TOKEN}".join([prompt_prefix(), convo.render()])
         response = openai.Completion.create(
             engine="text-davinci-003",
             prompt=rendered,
@@ -106,18 +140,20 @@ async def process_response(
     if status is CompletionResult.OK or status is CompletionResult.MODERATION_FLAGGED:
         sent_message = None
         if not reply_text:
-            sent_message = await thread.send(
+            sent_message = await scheduler.send(
+                thread,
+                Priority.REPLY,
                 embed=discord.Embed(
                     description=f"**Invalid response** - empty response",
                     color=discord.Color.yellow(),
-                )
+                ),
             )
         else:
             shorter_response = split_into_shorter_messages(reply_text)
             for r in shorter_response:
-                sent_message = await thread.send(r)
+                sent_message = await scheduler.send(thread, Priority.REPLY, content=r)
         if status is CompletionResult.MODERATION_FLAGGED:
-            await send_moderation_flagged_message(
+            send_moderation_flagged_message(
                 guild=thread.guild,
                 user=user,
                 flagged_str=status_text,
@@ -125,39 +161,47 @@ async def process_response(
                 url=sent_message.jump_url if sent_message else "no url",
             )
 
-            await thread.send(
+            await scheduler.send(
+                thread,
+                Priority.REPLY,
                 embed=discord.Embed(
                     description=f"⚠️ **This conversation has been flagged by moderation.**",
                     color=discord.Color.yellow(),
-                )
+                ),
             )
     elif status is CompletionResult.MODERATION_BLOCKED:
-        await send_moderation_blocked_message(
+        send_moderation_blocked_message(
             guild=thread.guild,
             user=user,
             blocked_str=status_text,
             message=reply_text,
         )
 
-        await thread.send(
+        await scheduler.send(
+            thread,
+            Priority.REPLY,
             embed=discord.Embed(
                 description=f"❌ **The response has been blocked by moderation.**",
                 color=discord.Color.red(),
-            )
+            ),
         )
     elif status is CompletionResult.TOO_LONG:
         await close_thread(thread)
     elif status is CompletionResult.INVALID_REQUEST:
-        await thread.send(
+        await scheduler.send(
+            thread,
+            Priority.REPLY,
             embed=discord.Embed(
                 description=f"**Invalid request** - {status_text}",
                 color=discord.Color.yellow(),
-            )
+            ),
         )
     else:
-        await thread.send(
+        await scheduler.send(
+            thread,
+            Priority.REPLY,
             embed=discord.Embed(
                 description=f"**Error** - {status_text}",
                 color=discord.Color.yellow(),
-            )
+            ),
         )
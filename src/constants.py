@@ -1,41 +1,32 @@
 from dotenv import load_dotenv
 import os
-import dacite
-import yaml
-from typing import Dict, List
-from src.base import Config
 
+# snapshot before load_dotenv() so settings reloads can tell real env vars from .env values
+PROCESS_ENV = dict(os.environ)
 load_dotenv()
 
-
-# load config.yaml
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
-CONFIG: Config = dacite.from_dict(
-    Config, yaml.safe_load(open(os.path.join(SCRIPT_DIR, "config.yaml"), "r"))
-)
-
-BOT_NAME = CONFIG.name
-BOT_INSTRUCTIONS = CONFIG.instructions
-EXAMPLE_CONVOS = CONFIG.example_conversations
 
 DISCORD_BOT_TOKEN = os.environ["DISCORD_BOT_TOKEN"]
 DISCORD_CLIENT_ID = os.environ["DISCORD_CLIENT_ID"]
 OPENAI_API_KEY = os.environ["OPENAI_API_KEY"]
 
-ALLOWED_SERVER_IDS: List[int] = []
-server_ids = os.environ["ALLOWED_SERVER_IDS"].split(",")
-for s in server_ids:
-    ALLOWED_SERVER_IDS.append(int(s))
+# append anonymized message timings here, for src/replay.py. Off when unset
+TRAFFIC_RECORD_PATH = os.environ.get("TRAFFIC_RECORD_PATH") or None
+
+# replies that were still pending at shutdown, sent on the next start
+PENDING_REPLIES_PATH = os.environ.get("PENDING_REPLIES_PATH") or os.path.join(
+    SCRIPT_DIR, "pending_replies.json"
+)
 
-SERVER_TO_MODERATION_CHANNEL: Dict[int, int] = {}
-server_channels = os.environ.get("SERVER_TO_MODERATION_CHANNEL", "").split(",")
-for s in server_channels:
-    values = s.split(":")
-    SERVER_TO_MODERATION_CHANNEL[int(values[0])] = int(values[1])
+# how many messages discord.py keeps in memory across all channels, replies
+# fetch thread history so this only saves a fetch for recent edits and deletes
+MAX_CACHED_MESSAGES = int(os.environ.get("MAX_CACHED_MESSAGES") or 500)
 
 # Send Messages, Create Public Threads, Send Messages in Threads, Manage Messages, Manage Threads, Read Message History, Use Slash Command
 BOT_INVITE_URL = f"https://discord.com/api/oauth2/authorize?client_id={DISCORD_CLIENT_ID}&permissions=328565073920&scope=bot"
 
+# defaults, can be overridden per category in config.yaml
 MODERATION_VALUES_FOR_BLOCKED = {
     "hate": 0.5,
     "hate/threatening": 0.1,
@@ -65,3 +56,11 @@ INACTIVATE_THREAD_PREFIX = "💬❌"
 MAX_CHARS_PER_REPLY_MSG = (
     1500  # discord has a 2k limit, we just break message into 1.5k
 )
+SECONDS_BETWEEN_SETTINGS_CHECKS = 5  # how often config.yaml and .env are checked for changes
+MAX_CONCURRENT_REST_CALLS = 8  # discord allows 50 requests/s globally, most of ours are per channel
+SECONDS_BETWEEN_TYPING_CALLS = 5  # typing lasts ~10s, same interval discord.py uses
+SECONDS_BETWEEN_REST_METRICS = 300
+MAX_RESIDENT_THREADS = 500  # least recently active threads past this are forgotten
+SECONDS_BEFORE_THREAD_IDLE = 60 * 60  # same as the auto archive duration of our threads
+SECONDS_BETWEEN_THREAD_SWEEPS = 300
+SECONDS_TO_DRAIN = 20  # heroku sends SIGKILL 30s after SIGTERM
@@ -0,0 +1,251 @@
+from dataclasses import dataclass, asdict
+from contextlib import contextmanager
+import asyncio
+import json
+import logging
+import os
+import time
+import discord
+from typing import Dict, Iterator, List, Optional, Set
+from src.base import Message
+from src.completion import (
+    CompletionData,
+    CompletionResult,
+    generate_completion_response,
+    process_response,
+)
+from src.constants import (
+    ACTIVATE_THREAD_PREFX,
+    PENDING_REPLIES_PATH,
+    SECONDS_TO_DRAIN,
+)
+from src.lifecycle import tracker
+from src.recorder import recorder
+from src.rest import scheduler, Priority
+from src.moderation import moderate_message, join_moderation_logs
+from src.utils import is_last_message_stale, thread_history
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PendingReply:
+    guild_id: int
+    thread_id: int
+    user: str
+    messages: List[Message]
+    # the user message being answered, a newer one in the thread means the
+    # history is rebuilt. None for /chat, where the prompt is the command
+    message_id: Optional[int] = None
+    # set once the completion is back, so a restart doesn't pay for it twice
+    status: Optional[str] = None
+    reply_text: Optional[str] = None
+    status_text: Optional[str] = None
+
+    def set_response(self, response_data: CompletionData):
+        self.status = response_data.status.name
+        self.reply_text = response_data.reply_text
+        self.status_text = response_data.status_text
+
+    def clear_response(self):
+        self.status = None
+        self.reply_text = None
+        self.status_text = None
+
+    def response(self) -> Optional[CompletionData]:
+        if self.status is None:
+            return None
+        return CompletionData(
+            status=CompletionResult[self.status],
+            reply_text=self.reply_text,
+            status_text=self.status_text,
+        )
+
+    @staticmethod
+    def from_dict(data: Dict) -> "PendingReply":
+        messages = [Message(**m) for m in data.pop("messages")]
+        return PendingReply(messages=messages, **data)
+
+
+class Drain:
+    """On shutdown, stops taking new messages, gives in-flight replies time to
+    finish and saves the ones that don't so the next start can send them."""
+
+    def __init__(self, path: str = PENDING_REPLIES_PATH):
+        self.path = path
+        self.draining = False
+        self._handlers: Set[asyncio.Task] = set()
+        self._pending: Dict[asyncio.Task, PendingReply] = {}
+        self._deferred: Set[int] = set()
+
+    def accept(self) -> bool:
+        """Called when a handler starts. Returns False once draining, otherwise
+        registers the handler so shutdown waits for it."""
+        if self.draining:
+            return False
+        task = asyncio.current_task()
+        self._handlers.add(task)
+        task.add_done_callback(self._handlers.discard)
+        return True
+
+    def defer(self, reply: PendingReply) -> bool:
+        """Saves a message that came in while draining so the next start
+        answers it. Returns False if its thread was already deferred."""
+        self.save([reply])
+        first = reply.thread_id not in self._deferred
+        self._deferred.add(reply.thread_id)
+        return first
+
+    @contextmanager
+    def track(self, reply: PendingReply) -> Iterator[PendingReply]:
+        task = asyncio.current_task()
+        self._pending[task] = reply
+        try:
+            yield reply
+        finally:
+            self._pending.pop(task, None)
+
+    async def drain(self, timeout: float = SECONDS_TO_DRAIN):
+        self.draining = True
+        start = time.monotonic()
+        logger.info(f"Draining, waiting up to {timeout}s for in-flight replies")
+
+        tasks = self._handlers | tracker.all_tasks()
+        finished = len(tasks)
+        if tasks:
+            _, unfinished = await asyncio.wait(tasks, timeout=timeout)
+            finished -= len(unfinished)
+            saved = [self._pending[t] for t in unfinished if t in self._pending]
+            self.save(saved)
+            for task in unfinished:
+                task.cancel()
+        else:
+            saved = []
+
+        # calls queued by replies that just finished still need a moment to go out
+        remaining = max(timeout - (time.monotonic() - start), 1.0)
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(join_moderation_logs(), scheduler.join()),
+                timeout=remaining,
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Gave up waiting for queued discord calls")
+        recorder.close()
+
+        logger.info(
+            f"Drained in {time.monotonic() - start:.1f}s: {finished} finished, {len(saved)} saved for restart"
+        )
+
+    def save(self, replies: List[PendingReply]):
+        if not replies:
+            return
+        # merged with what is already there, messages that come in while
+        # draining are saved one at a time
+        by_thread = {r.thread_id: r for r in self._read()}
+        for reply in replies:
+            saved = by_thread.get(reply.thread_id)
+            # no messages means rebuild from the thread, which covers both
+            if saved is None or saved.messages or not reply.messages:
+                by_thread[reply.thread_id] = reply
+        # written aside and swapped in, a kill mid-write keeps the old file
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump([asdict(r) for r in by_thread.values()], f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Failed to save {len(replies)} pending replies: {e!r}")
+
+    def _read(self) -> List[PendingReply]:
+        if not os.path.exists(self.path):
+            return []
+        try:
+            with open(self.path, "r") as f:
+                return [PendingReply.from_dict(d) for d in json.load(f)]
+        except Exception as e:
+            logger.warning(f"Failed to load pending replies: {e!r}")
+            return []
+
+    def load(self) -> List[PendingReply]:
+        if not os.path.exists(self.path):
+            return []
+        replies = self._read()
+        # only ever try them once
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            logger.warning(f"Failed to remove pending replies: {e!r}")
+        return replies
+
+drain = Drain()
+
+
+async def resume_pending_replies(client: discord.Client):
+    replies = drain.load()
+    if replies:
+        logger.info(f"Resuming {len(replies)} replies pending from last shutdown")
+        await asyncio.gather(*(resume_reply(client, reply) for reply in replies))
+
+
+async def latest_message(thread: discord.Thread) -> Optional[discord.Message]:
+    # the cache is empty after a restart, so ask discord
+    async for message in thread.history(limit=1):
+        return message
+    return None
+
+
+async def resume_reply(client: discord.Client, reply: PendingReply):
+    try:
+        guild = client.get_guild(reply.guild_id)
+        if guild is None:
+            return
+        thread = await scheduler.fetch_channel(guild, reply.thread_id, Priority.REPLY)
+        if (
+            not isinstance(thread, discord.Thread)
+            or thread.archived
+            or thread.locked
+            or not thread.name.startswith(ACTIVATE_THREAD_PREFX)
+        ):
+            return
+
+        last_message = await latest_message(thread)
+        if reply.message_id is not None or not reply.messages:
+            if last_message is None or last_message.author.id == client.user.id:
+                # answered before we went down, or nothing left to answer
+                return
+            if last_message.id != reply.message_id or not reply.messages:
+                # saved without history, or more came in since it was saved,
+                # answer the thread as it is now
+                reply.message_id = last_message.id
+                reply.user = str(last_message.author)
+                reply.messages = await thread_history(thread)
+                reply.clear_response()
+                # it never went through on_message, so it was not moderated
+                _, blocked_str = moderate_message(
+                    message=last_message.content, user=last_message.author
+                )
+                if len(blocked_str) > 0:
+                    return
+
+        tracker.touch(thread.id, task=asyncio.current_task())
+        with drain.track(reply):
+            response_data = reply.response()
+            if response_data is None:
+                async with scheduler.typing(thread):
+                    response_data = await generate_completion_response(
+                        messages=reply.messages, user=reply.user
+                    )
+                reply.set_response(response_data)
+            if is_last_message_stale(
+                interaction_message=last_message,
+                last_message=thread.last_message,
+                bot_id=client.user.id,
+            ):
+                # someone wrote while we were generating, on_message answers that
+                return
+            await process_response(
+                user=reply.user, thread=thread, response_data=response_data
+            )
+    except Exception as e:
+        logger.exception(e)
@@ -0,0 +1,220 @@
+import asyncio
+import discord
+from discord import Message as DiscordMessage
+from src.base import Message
+from src.constants import (
+    ACTIVATE_THREAD_PREFX,
+    SECONDS_DELAY_RECEIVING_MSG,
+)
+from src.utils import (
+    logger,
+    is_last_message_stale,
+    thread_history,
+)
+from src.rest import scheduler, Priority
+from src.recorder import TrafficEvent, recorder
+from src.lifecycle import tracker
+from src.drain import drain, PendingReply
+from src.completion import generate_completion_response, process_response
+from src.moderation import (
+    moderate_message,
+    send_moderation_blocked_message,
+    send_moderation_flagged_message,
+)
+
+# What happens once chat_command or on_message has accepted a message. Kept out
+# of main.py so src/replay.py can run exactly this against fakes.
+
+
+async def start_chat(
+    interaction: discord.Interaction, message: str, event: TrafficEvent
+):
+    user = interaction.user
+    try:
+        # moderate the message
+        with event.timing("mod_ms"):
+            flagged_str, blocked_str = moderate_message(message=message, user=user)
+        send_moderation_blocked_message(
+            guild=interaction.guild,
+            user=user,
+            blocked_str=blocked_str,
+            message=message,
+        )
+        if len(blocked_str) > 0:
+            # message was blocked
+            event.status = "blocked"
+            await interaction.response.send_message(
+                f"Your prompt has been blocked by moderation.\n{message}",
+                ephemeral=True,
+            )
+            return
+
+        embed = discord.Embed(
+            description=f"<@{user.id}> wants to chat! 🤖💬",
+            color=discord.Color.teal(),
+        )
+        embed.add_field(name=user.name, value=message)
+
+        if len(flagged_str) > 0:
+            # message was flagged
+            embed.color = discord.Color.yellow()
+            embed.title = "⚠️ This prompt was flagged by moderation."
+
+        await interaction.response.send_message(embed=embed)
+        response = await interaction.original_response()
+
+        send_moderation_flagged_message(
+            guild=interaction.guild,
+            user=user,
+            flagged_str=flagged_str,
+            message=message,
+            url=response.jump_url,
+        )
+    except Exception as e:
+        logger.exception(e)
+        await interaction.response.send_message(
+            f"Failed to start chat {str(e)}", ephemeral=True
+        )
+        return
+
+    # create the thread
+    thread = await response.create_thread(
+        name=f"{ACTIVATE_THREAD_PREFX} {user.name[:20]} - {message[:30]}",
+        slowmode_delay=1,
+        reason="gpt-bot",
+        auto_archive_duration=60,
+    )
+    event.th = recorder.thread_key(thread.id)
+    tracker.touch(thread.id, task=asyncio.current_task())
+
+    messages = [Message(user=user.name, text=message)]
+    pending = PendingReply(
+        guild_id=interaction.guild.id,
+        thread_id=thread.id,
+        user=str(user),
+        messages=messages,
+    )
+    with drain.track(pending):
+        async with scheduler.typing(thread):
+            # fetch completion
+            event.n = len(messages)
+            with event.timing("comp_ms"):
+                response_data = await generate_completion_response(
+                    messages=messages, user=user
+                )
+            pending.set_response(response_data)
+            event.status = response_data.status.name
+            event.reply = len(response_data.reply_text or "")
+            # send the result
+            await process_response(
+                user=user, thread=thread, response_data=response_data
+            )
+
+
+async def reply_in_thread(
+    message: DiscordMessage, thread: discord.Thread, bot_id: int, event: TrafficEvent
+):
+    event.th = recorder.thread_key(thread.id)
+    tracker.touch(thread.id, task=asyncio.current_task())
+
+    # moderate the message
+    with event.timing("mod_ms"):
+        flagged_str, blocked_str = moderate_message(
+            message=message.content, user=message.author
+        )
+    send_moderation_blocked_message(
+        guild=message.guild,
+        user=message.author,
+        blocked_str=blocked_str,
+        message=message.content,
+    )
+    if len(blocked_str) > 0:
+        event.status = "blocked"
+        try:
+            await scheduler.delete_message(message)
+            await scheduler.send(
+                thread,
+                Priority.REPLY,
+                embed=discord.Embed(
+                    description=f"❌ **{message.author}'s message has been deleted by moderation.**",
+                    color=discord.Color.red(),
+                ),
+            )
+            return
+        except Exception as e:
+            await scheduler.send(
+                thread,
+                Priority.REPLY,
+                embed=discord.Embed(
+                    description=f"❌ **{message.author}'s message has been blocked by moderation but could not be deleted. Missing Manage Messages permission in this Channel.**",
+                    color=discord.Color.red(),
+                ),
+            )
+            return
+    send_moderation_flagged_message(
+        guild=message.guild,
+        user=message.author,
+        flagged_str=flagged_str,
+        message=message.content,
+        url=message.jump_url,
+    )
+    if len(flagged_str) > 0:
+        await scheduler.send(
+            thread,
+            Priority.REPLY,
+            embed=discord.Embed(
+                description=f"⚠️ **{message.author}'s message has been flagged by moderation.**",
+                color=discord.Color.yellow(),
+            ),
+        )
+
+    # wait a bit in case user has more messages
+    if SECONDS_DELAY_RECEIVING_MSG > 0:
+        await asyncio.sleep(SECONDS_DELAY_RECEIVING_MSG)
+        if is_last_message_stale(
+            interaction_message=message,
+            last_message=thread.last_message,
+            bot_id=bot_id,
+        ):
+            # there is another message, so ignore this one
+            event.status = "superseded"
+            return
+
+    logger.info(
+        f"Thread message to process - {message.author}: {message.content[:50]} - {thread.name} {thread.jump_url}"
+    )
+
+    channel_messages = await thread_history(thread)
+    event.n = len(channel_messages)
+
+    pending = PendingReply(
+        guild_id=message.guild.id,
+        thread_id=thread.id,
+        user=str(message.author),
+        messages=channel_messages,
+        message_id=message.id,
+    )
+    with drain.track(pending):
+        # generate the response
+        async with scheduler.typing(thread):
+            with event.timing("comp_ms"):
+                response_data = await generate_completion_response(
+                    messages=channel_messages, user=message.author
+                )
+        pending.set_response(response_data)
+        event.status = response_data.status.name
+        event.reply = len(response_data.reply_text or "")
+
+        if is_last_message_stale(
+            interaction_message=message,
+            last_message=thread.last_message,
+            bot_id=bot_id,
+        ):
+            # there is another message and its not from us, so ignore this response
+            event.status = "superseded"
+            return
+
+        # send response
+        await process_response(
+            user=message.author, thread=thread, response_data=response_data
+        )
@@ -0,0 +1,140 @@
+from dataclasses import dataclass, field
+from collections import OrderedDict
+import asyncio
+import logging
+import os
+import time
+from typing import Callable, Dict, List, Optional, Set
+from src.constants import (
+    MAX_RESIDENT_THREADS,
+    SECONDS_BEFORE_THREAD_IDLE,
+    SECONDS_BETWEEN_THREAD_SWEEPS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ThreadState:
+    last_active: float
+    tasks: Set[asyncio.Task] = field(default_factory=set)
+
+
+class ThreadTracker:
+    """Keeps track of the threads we are talking in, least recently active
+    first. Anything that keeps per-thread state registers an evict listener so
+    it is dropped when a thread is archived, locked, deleted, goes idle or gets
+    pushed out by the cap."""
+
+    def __init__(
+        self,
+        max_threads: int = MAX_RESIDENT_THREADS,
+        idle_seconds: float = SECONDS_BEFORE_THREAD_IDLE,
+    ):
+        self.max_threads = max_threads
+        self.idle_seconds = idle_seconds
+        self.evicted = 0
+        self._threads: "OrderedDict[int, ThreadState]" = OrderedDict()
+        self._evict_listeners: List[Callable[[int], None]] = []
+        self._closing: Set[int] = set()
+
+    def __len__(self):
+        return len(self._threads)
+
+    def add_evict_listener(self, listener: Callable[[int], None]):
+        self._evict_listeners.append(listener)
+
+    def touch(self, thread_id: int, task: Optional[asyncio.Task] = None):
+        state = self._threads.get(thread_id)
+        if state is None:
+            state = self._threads[thread_id] = ThreadState(last_active=0.0)
+        state.last_active = time.monotonic()
+        self._threads.move_to_end(thread_id)
+        if task is not None:
+            # work for a thread is cancelled if the thread goes away under it
+            state.tasks.add(task)
+            task.add_done_callback(state.tasks.discard)
+        if len(self._threads) > self.max_threads:
+            self.evict_oldest(len(self._threads) - self.max_threads, reason="cap")
+
+    def pending_tasks(self) -> int:
+        return sum(len(state.tasks) for state in self._threads.values())
+
+    def all_tasks(self) -> Set[asyncio.Task]:
+        return {task for state in self._threads.values() for task in state.tasks}
+
+    def mark_closing(self, thread_id: int):
+        # we are archiving this thread ourselves, the handler doing it must not
+        # be cancelled when the update for it comes back through the gateway
+        self._closing.add(thread_id)
+
+    def unmark_closing(self, thread_id: int):
+        self._closing.discard(thread_id)
+
+    def evict(self, thread_id: int, reason: str):
+        # runs in the gateway event's task, never in a handler for the thread
+        closing = thread_id in self._closing
+        self._closing.discard(thread_id)
+        state = self._threads.pop(thread_id, None)
+        if state is None:
+            return
+        self.evicted += 1
+        if not closing:
+            for task in list(state.tasks):
+                task.cancel()
+        for listener in self._evict_listeners:
+            try:
+                listener(thread_id)
+            except Exception as e:
+                logger.exception(e)
+        logger.info(f"Evicted thread {thread_id} ({reason})")
+
+    def evict_oldest(self, count: int, reason: str):
+        # threads with work in flight are still in use, leave them be
+        candidates = [
+            thread_id for thread_id, state in self._threads.items() if not state.tasks
+        ][:count]
+        for thread_id in candidates:
+            self.evict(thread_id, reason=reason)
+
+    def evict_idle(self):
+        cutoff = time.monotonic() - self.idle_seconds
+        idle = [
+            thread_id
+            for thread_id, state in self._threads.items()
+            if state.last_active < cutoff and not state.tasks
+        ]
+        for thread_id in idle:
+            self.evict(thread_id, reason="idle")
+
+
+tracker = ThreadTracker()
+
+
+def resident_memory_mb() -> Optional[float]:
+    # current RSS, only available where there is procfs
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+async def manage_threads(
+    cache_sizes: Callable[[], Dict[str, int]],
+    interval: float = SECONDS_BETWEEN_THREAD_SWEEPS,
+):
+    """Evicts idle threads and logs resident memory along with the size of
+    each cache from `cache_sizes`."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            tracker.evict_idle()
+            rss_mb = resident_memory_mb()
+            rss = f"{rss_mb:.1f}MB" if rss_mb is not None else "n/a"
+            logger.info(
+                f"Memory: rss={rss} threads={len(tracker)} pending={tracker.pending_tasks()} evicted={tracker.evicted} {cache_sizes()}"
+            )
+        except Exception as e:
+            logger.exception(e)
@@ -1,53 +1,72 @@
 import discord
 from discord import Message as DiscordMessage
 import logging
-from src.base import Message, Conversation
 from src.constants import (
     BOT_INVITE_URL,
     DISCORD_BOT_TOKEN,
-    EXAMPLE_CONVOS,
     ACTIVATE_THREAD_PREFX,
     MAX_THREAD_MESSAGES,
-    SECONDS_DELAY_RECEIVING_MSG,
+    MAX_CACHED_MESSAGES,
 )
 import asyncio
+import collections
+import signal
 from src.utils import (
     logger,
     should_block,
     close_thread,
-    is_last_message_stale,
-    discord_message_to_message,
     save_a_copy,
 )
 import io
+from typing import Dict, List, Optional
 from src import completion
-from src.completion import generate_completion_response, process_response
-from src.moderation import (
-    moderate_message,
-    send_moderation_blocked_message,
-    send_moderation_flagged_message,
-)
+from src.settings import watch_settings
+from src.rest import scheduler, Priority, log_rest_metrics
+from src.recorder import recorder
+from src.lifecycle import tracker, manage_threads
+from src.drain import drain, PendingReply, resume_pending_replies
+from src.handlers import start_chat, reply_in_thread
 
 intents = discord.Intents.default()
 intents.message_content = True
 
-client = discord.Client(intents=intents)
+client = discord.Client(intents=intents, max_messages=MAX_CACHED_MESSAGES)
 tree = discord.app_commands.CommandTree(client)
+background_tasks: List[asyncio.Task] = []
+shutdown_task: Optional[asyncio.Task] = None
+
+
+def forget_thread_messages(thread_id: int):
+    # discord.py has no public way to drop cached messages, its cache is a
+    # deque bounded by max_messages so a forgotten thread's messages would
+    # otherwise sit there until pushed out. That deque is private, if a
+    # discord.py update moves it this does nothing and max_messages still holds
+    messages = getattr(getattr(client, "_connection", None), "_messages", None)
+    if isinstance(messages, collections.deque) and messages:
+        kept = [m for m in messages if m.channel.id != thread_id]
+        if len(kept) != len(messages):
+            messages.clear()
+            messages.extend(kept)
+
+
+tracker.add_evict_listener(scheduler.forget_channel)
+tracker.add_evict_listener(forget_thread_messages)
+
+
+def cache_sizes() -> Dict[str, int]:
+    return {"messages": len(client.cached_messages), **scheduler.cache_sizes()}
 
 
 @client.event
 async def on_ready():
     logger.info(f"We have logged in as {client.user}. Invite URL: {BOT_INVITE_URL}")
     completion.MY_BOT_NAME = client.user.name
-    completion.MY_BOT_EXAMPLE_CONVOS = []
-    for c in EXAMPLE_CONVOS:
-        messages = []
-        for m in c.messages:
-            if m.user == "Lenard":
-                messages.append(Message(user=client.user.name, text=m.text))
-            else:
-                messages.append(m)
-        completion.MY_BOT_EXAMPLE_CONVOS.append(Conversation(messages=messages))
+    if not background_tasks:
+        # on_ready fires again after reconnects, only start these once
+        background_tasks.append(asyncio.create_task(watch_settings()))
+        background_tasks.append(asyncio.create_task(log_rest_metrics()))
+        background_tasks.append(asyncio.create_task(manage_threads(cache_sizes)))
+        background_tasks.append(asyncio.create_task(resume_pending_replies(client)))
     await tree.sync()
 
 # /chat message:
@@ -78,6 +97,7 @@ async def save_menu(interaction: discord.Interaction, message: discord.Message):
 @discord.app_commands.checks.bot_has_permissions(view_channel=True)
 @discord.app_commands.checks.bot_has_permissions(manage_threads=True)
 async def chat_command(int: discord.Interaction, message: str):
+    event = None
     try:
         # only support creating thread in text channel
         if not isinstance(int.channel, discord.TextChannel):
@@ -87,71 +107,17 @@ async def chat_command(int: discord.Interaction, message: str):
         if should_block(guild=int.guild):
             return
 
-        user = int.user
-        logger.info(f"Chat command by {user} {message[:20]}")
-        try:
-            # moderate the message
-            flagged_str, blocked_str = moderate_message(message=message, user=user)
-            await send_moderation_blocked_message(
-                guild=int.guild,
-                user=user,
-                blocked_str=blocked_str,
-                message=message,
-            )
-            if len(blocked_str) > 0:
-                # message was blocked
-                await int.response.send_message(
-                    f"Your prompt has been blocked by moderation.\n{message}",
-                    ephemeral=True,
-                )
-                return
-
-            embed = discord.Embed(
-                description=f"<@{user.id}> wants to chat! 🤖💬",
-                color=discord.Color.teal(),
-            )
-            embed.add_field(name=user.name, value=message)
-
-            if len(flagged_str) > 0:
-                # message was flagged
-                embed.color = discord.Color.yellow()
-                embed.title = "⚠️ This prompt was flagged by moderation."
-
-            await int.response.send_message(embed=embed)
-            response = await int.original_response()
-
-            await send_moderation_flagged_message(
-                guild=int.guild,
-                user=user,
-                flagged_str=flagged_str,
-                message=message,
-                url=response.jump_url,
-            )
-        except Exception as e:
-            logger.exception(e)
+        # shutting down, don't start anything new
+        if not drain.accept():
             await int.response.send_message(
-                f"Failed to start chat {str(e)}", ephemeral=True
+                "Restarting, try again in a minute.", ephemeral=True
             )
             return
 
-        # create the thread
-        thread = await response.create_thread(
-            name=f"{ACTIVATE_THREAD_PREFX} {user.name[:20]} - {message[:30]}",
-            slowmode_delay=1,
-            reason="gpt-bot",
-            auto_archive_duration=60,
-        )
-
-        async with thread.typing():
-            # fetch completion
-            messages = [Message(user=user.name, text=message)]
-            response_data = await generate_completion_response(
-                messages=messages, user=user
-            )
-            # send the result
-            await process_response(
-                user=user, thread=thread, response_data=response_data
-            )
+        user = int.user
+        logger.info(f"Chat command by {user} {message[:20]}")
+        event = recorder.start("chat", size=len(message))
+        await start_chat(interaction=int, message=message, event=event)
     except Exception as e:
         logger.exception(e)
         try:
@@ -160,17 +126,23 @@ async def chat_command(int: discord.Interaction, message: str):
             )
         except Exception as e:
             logger.exception(e)
-
+    finally:
+        if event is not None:
+            recorder.record(event)
 
 
 # calls for each message
 @client.event
 async def on_message(message: DiscordMessage):
+    event = None
     try:
         # ignore messages from the bot
         if message.author == client.user:
             return
 
+        # registered before the filters below, so shutdown waits for them too
+        accepted = drain.accept()
+
         # block servers not in allow list
         if should_block(guild=message.guild):
             return
@@ -199,91 +171,77 @@ async def on_message(message: DiscordMessage):
             await close_thread(thread=thread)
             return
 
-        # moderate the message
-        flagged_str, blocked_str = moderate_message(
-            message=message.content, user=message.author
-        )
-        await send_moderation_blocked_message(
-            guild=message.guild,
-            user=message.author,
-            blocked_str=blocked_str,
-            message=message.content,
-        )
-        if len(blocked_str) > 0:
-            try:
-                await message.delete()
-                await thread.send(
-                    embed=discord.Embed(
-                        description=f"❌ **{message.author}'s message has been deleted by moderation.**",
-                        color=discord.Color.red(),
-                    )
-                )
-                return
-            except Exception as e:
-                await thread.send(
-                    embed=discord.Embed(
-                        description=f"❌ **{message.author}'s message has been blocked by moderation but could not be deleted. Missing Manage Messages permission in this Channel.**",
-                        color=discord.Color.red(),
-                    )
-                )
-                return
-        await send_moderation_flagged_message(
-            guild=message.guild,
-            user=message.author,
-            flagged_str=flagged_str,
-            message=message.content,
-            url=message.jump_url,
-        )
-        if len(flagged_str) > 0:
-            await thread.send(
-                embed=discord.Embed(
-                    description=f"⚠️ **{message.author}'s message has been flagged by moderation.**",
-                    color=discord.Color.yellow(),
-                )
+        if not accepted:
+            # shutting down, the next start answers from the thread's history
+            pending = PendingReply(
+                guild_id=message.guild.id,
+                thread_id=thread.id,
+                user=str(message.author),
+                messages=[],
+                message_id=message.id,
             )
-
-        # wait a bit in case user has more messages
-        if SECONDS_DELAY_RECEIVING_MSG > 0:
-            await asyncio.sleep(SECONDS_DELAY_RECEIVING_MSG)
-            if is_last_message_stale(
-                interaction_message=message,
-                last_message=thread.last_message,
-                bot_id=client.user.id,
-            ):
-                # there is another message, so ignore this one
-                return
-
-        logger.info(
-            f"Thread message to process - {message.author}: {message.content[:50]} - {thread.name} {thread.jump_url}"
-        )
-
-        channel_messages = [
-            await discord_message_to_message(message)
-            async for message in thread.history(limit=MAX_THREAD_MESSAGES)
-        ]
-        channel_messages = [x for x in channel_messages if x is not None]
-        channel_messages.reverse()
-
-        # generate the response
-        async with thread.typing():
-            response_data = await generate_completion_response(
-                messages=channel_messages, user=message.author
-            )
-
-        if is_last_message_stale(
-            interaction_message=message,
-            last_message=thread.last_message,
-            bot_id=client.user.id,
-        ):
-            # there is another message and its not from us, so ignore this response
+            if drain.defer(pending):
+                await scheduler.send(
+                    thread, Priority.REPLY, content="Restarting, I'll reply in a minute."
+                )
             return
 
-        # send response
-        await process_response(
-            user=message.author, thread=thread, response_data=response_data
+        event = recorder.start("msg", size=len(message.content))
+        await reply_in_thread(
+            message=message, thread=thread, bot_id=client.user.id, event=event
         )
     except Exception as e:
         logger.exception(e)
+    finally:
+        if event is not None:
+            recorder.record(event)
+
+
+@client.event
+async def on_raw_thread_update(payload: discord.RawThreadUpdateEvent):
+    metadata = payload.data.get("thread_metadata", {})
+    if metadata.get("locked"):
+        tracker.evict(payload.thread_id, reason="locked")
+    elif metadata.get("archived"):
+        tracker.evict(payload.thread_id, reason="archived")
+
+
+@client.event
+async def on_raw_thread_delete(payload: discord.RawThreadDeleteEvent):
+    tracker.evict(payload.thread_id, reason="deleted")
+
+
+async def shutdown():
+    await drain.drain()
+    for task in background_tasks:
+        task.cancel()
+    await client.close()
 
 
-client.run(DISCORD_BOT_TOKEN)
+def handle_shutdown_signal():
+    global shutdown_task
+    if shutdown_task is None:
+        shutdown_task = asyncio.create_task(shutdown())
+    elif not shutdown_task.done():
+        # signalled again while draining, stop without waiting
+        logger.info("Stopping without draining")
+        shutdown_task.cancel()
+        shutdown_task = asyncio.create_task(client.close())
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, handle_shutdown_signal)
+        except NotImplementedError:
+            # windows, ctrl+c still stops the bot, just without draining
+            pass
+    # utils.py already configures the root logger, same as client.run did
+    discord.utils.setup_logging(root=False)
+    async with client:
+        await client.start(DISCORD_BOT_TOKEN)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
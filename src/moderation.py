@@ -1,12 +1,13 @@
-from src.constants import (
-    SERVER_TO_MODERATION_CHANNEL,
-    MODERATION_VALUES_FOR_BLOCKED,
-    MODERATION_VALUES_FOR_FLAGGED,
-)
+from src import settings
+import asyncio
 import openai
-from typing import Optional, Tuple
+from typing import Optional, Set, Tuple
 import discord
 from src.utils import logger
+from src.rest import scheduler, Priority
+
+# moderation logs go out in the background, so replies don't wait behind them
+_log_tasks: Set[asyncio.Task] = set()
 
 
 def moderate_message(
@@ -17,14 +18,15 @@ def moderate_message(
     )
     category_scores = moderation_response.results[0]["category_scores"] or {}
 
+    current = settings.current()
     blocked_str = ""
     flagged_str = ""
     for category, score in category_scores.items():
-        if score > MODERATION_VALUES_FOR_BLOCKED.get(category, 1.0):
+        if score > current.moderation_values_for_blocked.get(category, 1.0):
             blocked_str += f"({category}: {score})"
             logger.info(f"blocked {user} {category} {score}")
             break
-        if score > MODERATION_VALUES_FOR_FLAGGED.get(category, 1.0):
+        if score > current.moderation_values_for_flagged.get(category, 1.0):
             flagged_str += f"({category}: {score})"
             logger.info(f"flagged {user} {category} {score}")
     return (flagged_str, blocked_str)
@@ -35,14 +37,42 @@ async def fetch_moderation_channel(
 ) -> Optional[discord.abc.GuildChannel]:
     if not guild or not guild.id:
         return None
-    moderation_channel = SERVER_TO_MODERATION_CHANNEL.get(guild.id, None)
+    moderation_channel = settings.current().server_to_moderation_channel.get(
+        guild.id, None
+    )
     if moderation_channel:
-        channel = await guild.fetch_channel(moderation_channel)
+        channel = await scheduler.fetch_channel(
+            guild, moderation_channel, Priority.MODERATION
+        )
         return channel
     return None
 
 
-async def send_moderation_flagged_message(
+async def send_moderation_log(guild: discord.Guild, content: str):
+    moderation_channel = await fetch_moderation_channel(guild=guild)
+    if moderation_channel:
+        await scheduler.send(moderation_channel, Priority.MODERATION, content=content)
+
+
+def _log_failure(task: asyncio.Task):
+    _log_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Failed to send moderation log", exc_info=task.exception())
+
+
+def submit_moderation_log(guild: discord.Guild, content: str):
+    task = asyncio.create_task(send_moderation_log(guild=guild, content=content))
+    _log_tasks.add(task)
+    task.add_done_callback(_log_failure)
+
+
+async def join_moderation_logs():
+    # wait for logs already submitted, used when shutting down
+    if _log_tasks:
+        await asyncio.wait(set(_log_tasks))
+
+
+def send_moderation_flagged_message(
     guild: Optional[discord.Guild],
     user: str,
     flagged_str: Optional[str],
@@ -50,22 +80,20 @@ async def send_moderation_flagged_message(
     url: Optional[str],
 ):
     if guild and flagged_str and len(flagged_str) > 0:
-        moderation_channel = await fetch_moderation_channel(guild=guild)
-        if moderation_channel:
-            message = message[:100] if message else None
-            await moderation_channel.send(
-                f"⚠️ {user} - {flagged_str} - {message} - {url}"
-            )
+        message = message[:100] if message else None
+        submit_moderation_log(
+            guild=guild, content=f"⚠️ {user} - {flagged_str} - {message} - {url}"
+        )
 
 
-async def send_moderation_blocked_message(
+def send_moderation_blocked_message(
     guild: Optional[discord.Guild],
     user: str,
     blocked_str: Optional[str],
     message: Optional[str],
 ):
     if guild and blocked_str and len(blocked_str) > 0:
-        moderation_channel = await fetch_moderation_channel(guild=guild)
-        if moderation_channel:
-            message = message[:500] if message else None
-            await moderation_channel.send(f"❌ {user} - {blocked_str} - {message}")
+        message = message[:500] if message else None
+        submit_moderation_log(
+            guild=guild, content=f"❌ {user} - {blocked_str} - {message}"
+        )
@@ -0,0 +1,88 @@
+from dataclasses import dataclass, asdict
+from contextlib import contextmanager
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import IO, Iterator, Optional
+from src.constants import TRAFFIC_RECORD_PATH
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TrafficEvent:
+    """One handled message. Only sizes and timings are kept, never text or ids,
+    field names are short since there is one of these per line."""
+
+    k: str  # "chat" for /chat, "msg" for a thread message
+    gap: float = 0.0  # seconds since the previous event was received
+    th: str = ""  # salted hash of the thread id, only groups events per thread
+    size: int = 0  # characters in the user message
+    n: int = 0  # messages in the thread sent to the model
+    mod_ms: float = 0.0  # moderating the user message
+    comp_ms: float = 0.0  # completion, including moderating the response
+    reply: int = 0  # characters in the reply
+    status: str = ""
+
+    @contextmanager
+    def timing(self, field: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            setattr(self, field, round((time.perf_counter() - start) * 1000, 1))
+
+
+class TrafficRecorder:
+    def __init__(self, path: Optional[str]):
+        self.path = path
+        self._file: Optional[IO[str]] = None
+        self._last_received: Optional[float] = None
+        # a fresh salt per process, thread hashes can't be joined across runs
+        self._salt = os.urandom(8)
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def start(self, kind: str, size: int) -> TrafficEvent:
+        now = time.monotonic()
+        gap = 0.0 if self._last_received is None else now - self._last_received
+        self._last_received = now
+        return TrafficEvent(k=kind, gap=round(gap, 3), size=size)
+
+    def thread_key(self, thread_id: int) -> str:
+        if not self.enabled:
+            return ""
+        return hashlib.blake2b(
+            str(thread_id).encode(), key=self._salt, digest_size=4
+        ).hexdigest()
+
+    def record(self, event: TrafficEvent):
+        if not self.enabled:
+            return
+        try:
+            if self._file is None:
+                self._file = open(self.path, "a")
+            self._file.write(json.dumps(asdict(event), separators=(",", ":")) + "\n")
+            self._file.flush()
+        except OSError as e:
+            logger.warning(f"Failed to record traffic to {self.path}: {e!r}")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+recorder = TrafficRecorder(TRAFFIC_RECORD_PATH)
+
+
+def read_trace(path: str) -> Iterator[TrafficEvent]:
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                yield TrafficEvent(**json.loads(line))
+
@@ -0,0 +1,317 @@
+"""Replays a trace written by the traffic recorder (TRAFFIC_RECORD_PATH) through
+the same handlers chat_command and on_message run once they accept a message,
+with OpenAI and Discord swapped for local fakes that take as long as the
+recorded calls did. Run the same trace against two versions to compare them:
+
+    python -m src.replay traffic.jsonl --speed 10
+"""
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+# the modules below read these at import, the fakes never use them
+for key in ("DISCORD_BOT_TOKEN", "DISCORD_CLIENT_ID", "OPENAI_API_KEY"):
+    os.environ.setdefault(key, "replay")
+os.environ.setdefault("ALLOWED_SERVER_IDS", "0")
+
+import openai
+import discord
+from src import handlers
+from src.handlers import start_chat, reply_in_thread
+from src.recorder import TrafficEvent, read_trace
+from src.constants import TRAFFIC_RECORD_PATH, SECONDS_DELAY_RECEIVING_MSG
+
+SECONDS_PER_DISCORD_CALL = 0.05
+BLOCKING_SCORES = {"hate": 1.0}
+FLAGGING_SCORES = {"violence": 0.5}
+
+
+@dataclass
+class _Replaying:
+    event: TrafficEvent
+    speed: float
+    thread: Optional["FakeThread"] = None
+    moderation_calls: int = 0
+
+    def seconds(self, ms: float) -> float:
+        return max(ms, 0.0) / 1000 / self.speed
+
+
+_replaying: contextvars.ContextVar[_Replaying] = contextvars.ContextVar("replaying")
+
+
+def _moderation_response():
+    replaying = _replaying.get()
+    replaying.moderation_calls += 1
+    event = replaying.event
+    scores = {}
+    if replaying.moderation_calls == 1:
+        # the user message
+        if event.status == "blocked":
+            scores = BLOCKING_SCORES
+    elif event.status == "MODERATION_BLOCKED":
+        scores = BLOCKING_SCORES
+    elif event.status == "MODERATION_FLAGGED":
+        scores = FLAGGING_SCORES
+    return SimpleNamespace(results=[{"category_scores": scores}])
+
+
+def _completion_response():
+    replaying = _replaying.get()
+    event = replaying.event
+    if event.status == "TOO_LONG":
+        raise openai.error.InvalidRequestError(
+            "This model's maximum context length was exceeded (replay)", param=None
+        )
+    if event.status == "INVALID_REQUEST":
+        raise openai.error.InvalidRequestError("invalid request (replay)", param=None)
+    if event.status == "OTHER_ERROR":
+        raise openai.error.APIError("error (replay)")
+    if event.status == "superseded" and replaying.thread is not None:
+        # someone wrote again while the completion was running
+        replaying.thread.receive("x")
+    return SimpleNamespace(choices=[SimpleNamespace(text="x" * event.reply)])
+
+
+RESPONSE_MODERATED_STATUSES = ("OK", "MODERATION_FLAGGED", "MODERATION_BLOCKED")
+
+
+def _completion_seconds() -> float:
+    # comp_ms also covers moderating the response when there was one, which the
+    # moderation fake sleeps for separately
+    event = _replaying.get().event
+    comp_ms = event.comp_ms
+    if event.reply > 0 and event.status in RESPONSE_MODERATED_STATUSES:
+        comp_ms -= event.mod_ms
+    return _replaying.get().seconds(comp_ms)
+
+
+class FakeModeration:
+    @staticmethod
+    def create(**kwargs):
+        replaying = _replaying.get()
+        # the real client blocks, so this does too
+        time.sleep(replaying.seconds(replaying.event.mod_ms))
+        return _moderation_response()
+
+    @staticmethod
+    async def acreate(**kwargs):
+        replaying = _replaying.get()
+        await asyncio.sleep(replaying.seconds(replaying.event.mod_ms))
+        return _moderation_response()
+
+
+class FakeCompletion:
+    @staticmethod
+    def create(**kwargs):
+        time.sleep(_completion_seconds())
+        return _completion_response()
+
+    @staticmethod
+    async def acreate(**kwargs):
+        await asyncio.sleep(_completion_seconds())
+        return _completion_response()
+
+
+def install_fakes(speed: float = 1.0):
+    openai.Moderation = FakeModeration
+    openai.Completion = FakeCompletion
+    # scale the wait for follow up messages like every other recorded time
+    handlers.SECONDS_DELAY_RECEIVING_MSG = SECONDS_DELAY_RECEIVING_MSG / speed
+
+
+BOT = SimpleNamespace(id=1, name="replay-bot")
+USER = SimpleNamespace(id=2, name="replay-user")
+GUILD = SimpleNamespace(id=0, name="replay")
+
+
+class FakeMessage:
+    def __init__(self, thread: "FakeThread", author, content: str):
+        thread.message_ids += 1
+        self.id = thread.message_ids
+        self.channel = thread
+        self.guild = GUILD
+        self.author = author
+        self.content = content
+        self.type = discord.MessageType.default
+        self.reference = None
+        self.embeds = []
+        self.jump_url = f"replay://{thread.id}/{self.id}"
+
+    async def delete(self):
+        await asyncio.sleep(SECONDS_PER_DISCORD_CALL)
+
+
+class FakeThread:
+    def __init__(self, key: str):
+        self.id = hash(key)
+        self.name = f"replay {key}"
+        self.jump_url = f"replay://{self.id}"
+        self.guild = GUILD
+        self.owner_id = BOT.id
+        self.archived = False
+        self.locked = False
+        self.message_ids = 0
+        self.messages: List[FakeMessage] = []
+
+    @property
+    def last_message(self) -> Optional[FakeMessage]:
+        return self.messages[-1] if self.messages else None
+
+    def receive(self, content: str, author=USER) -> FakeMessage:
+        message = FakeMessage(self, author, content)
+        self.messages.append(message)
+        return message
+
+    async def send(self, content: Optional[str] = None, **kwargs):
+        await asyncio.sleep(SECONDS_PER_DISCORD_CALL)
+        return self.receive(content or "", author=BOT)
+
+    async def history(self, limit: Optional[int] = None):
+        await asyncio.sleep(SECONDS_PER_DISCORD_CALL)
+        for message in reversed(self.messages[-limit:] if limit else self.messages):
+            yield message
+
+    async def edit(self, **kwargs):
+        await asyncio.sleep(SECONDS_PER_DISCORD_CALL)
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+        return self
+
+    async def _typing(self):
+        await asyncio.sleep(SECONDS_PER_DISCORD_CALL)
+
+    def typing(self):
+        return self._typing()
+
+
+class FakeInteractionResponse:
+    def __init__(self, interaction: "FakeInteraction"):
+        self.interaction = interaction
+
+    async def send_message(self, content: Optional[str] = None, **kwargs):
+        await asyncio.sleep(SECONDS_PER_DISCORD_CALL)
+
+
+class FakeInteraction:
+    def __init__(self, key: str):
+        self.user = USER
+        self.guild = GUILD
+        self.response = FakeInteractionResponse(self)
+        self.thread = FakeThread(key)
+
+    async def original_response(self):
+        await asyncio.sleep(SECONDS_PER_DISCORD_CALL)
+        return SimpleNamespace(
+            jump_url=f"replay://{self.thread.id}/0", create_thread=self.create_thread
+        )
+
+    async def create_thread(self, **kwargs):
+        await asyncio.sleep(SECONDS_PER_DISCORD_CALL)
+        _replaying.get().thread = self.thread
+        return self.thread
+
+
+@dataclass
+class ReplayResult:
+    events: int = 0
+    wall_seconds: float = 0.0
+    latencies: Dict[str, List[float]] = field(default_factory=dict)
+    lag: List[float] = field(default_factory=list)
+
+    def summary(self) -> Dict:
+        result = {
+            "events": self.events,
+            "wall_seconds": round(self.wall_seconds, 3),
+            "events_per_second": round(self.events / max(self.wall_seconds, 1e-9), 2),
+            # how late events started, high lag means the loop was blocked
+            "start_lag_ms": _percentiles(self.lag),
+        }
+        for kind, latencies in sorted(self.latencies.items()):
+            result[f"{kind}_latency_ms"] = _percentiles(latencies)
+        return result
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def at(p: float) -> float:
+        return round(ordered[min(int(p * len(ordered)), len(ordered) - 1)] * 1000, 1)
+
+    return {"p50": at(0.5), "p95": at(0.95), "p99": at(0.99), "max": at(1.0)}
+
+
+async def replay_event(event: TrafficEvent, speed: float):
+    replaying = _Replaying(event=event, speed=speed)
+    _replaying.set(replaying)
+    key = event.th or str(id(event))
+    # the handlers record into this, it is never written out
+    handled = TrafficEvent(k=event.k, size=event.size)
+    text = "x" * event.size
+
+    if event.k == "chat":
+        interaction = FakeInteraction(key)
+        await start_chat(interaction=interaction, message=text, event=handled)
+        return
+
+    thread = replaying.thread = FakeThread(key)
+    for i in range(max(event.n - 1, 0)):
+        thread.receive(text, author=USER if i % 2 == 0 else BOT)
+    message = thread.receive(text)
+    if event.status == "superseded" and event.comp_ms == 0:
+        # the next message arrived while waiting for more
+        thread.receive(text)
+    await reply_in_thread(message=message, thread=thread, bot_id=BOT.id, event=handled)
+
+
+async def replay(events: List[TrafficEvent], speed: float = 1.0) -> ReplayResult:
+    result = ReplayResult()
+    tasks = []
+
+    async def run(event: TrafficEvent, due: float):
+        result.lag.append(max(time.perf_counter() - due, 0.0))
+        await replay_event(event, speed)
+        # from when the message would have arrived, like the user sees it
+        result.latencies.setdefault(event.k, []).append(time.perf_counter() - due)
+
+    start = time.perf_counter()
+    due = start
+    for event in events:
+        due += event.gap / speed
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(run(event, due)))
+    await asyncio.gather(*tasks)
+    result.events = len(events)
+    result.wall_seconds = time.perf_counter() - start
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("trace", nargs="?", default=TRAFFIC_RECORD_PATH)
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="divide all recorded times by this"
+    )
+    parser.add_argument("--limit", type=int, default=None, help="replay the first N")
+    args = parser.parse_args()
+    if not args.trace:
+        parser.error("no trace given and TRAFFIC_RECORD_PATH is not set")
+
+    events = list(read_trace(args.trace))[: args.limit]
+    install_fakes(speed=args.speed)
+    result = asyncio.run(replay(events, speed=args.speed))
+    print(json.dumps(result.summary(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,306 @@
+from dataclasses import dataclass, field
+from enum import IntEnum
+from collections import defaultdict
+from contextlib import asynccontextmanager
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+import discord
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+from src.constants import (
+    MAX_CONCURRENT_REST_CALLS,
+    SECONDS_BETWEEN_TYPING_CALLS,
+    SECONDS_BETWEEN_REST_METRICS,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    REPLY = 0  # replies users are waiting on
+    THREAD = 1  # thread edits, typing, deleting blocked messages
+    MODERATION = 2  # moderation channel logs
+
+
+@dataclass(order=True)
+class _Job:
+    priority: int
+    seq: int
+    bucket: str = field(compare=False)
+    call: Callable[["_Job"], Awaitable[Any]] = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+    kwargs: Dict[str, Any] = field(compare=False, default_factory=dict)
+    started: bool = field(compare=False, default=False)
+
+
+@dataclass
+class BucketStats:
+    queued: int = 0
+    submitted: int = 0
+    completed: int = 0
+    failed: int = 0
+    merged: int = 0
+    dropped: int = 0
+    busy_seconds: float = 0.0
+
+
+class RestScheduler:
+    """Runs discord REST calls one at a time per route bucket, highest priority
+    first, with at most `max_concurrent` calls in flight overall. discord.py still
+    handles the 429s, this keeps us from piling calls onto a bucket that is
+    already waiting and lets replies skip ahead of moderation logs."""
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_REST_CALLS):
+        self.max_concurrent = max_concurrent
+        self.stats: Dict[str, BucketStats] = defaultdict(BucketStats)
+        self._heap: List[_Job] = []
+        self._seq = itertools.count()
+        self._busy_buckets: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._in_flight = 0
+        self._pending_edits: Dict[int, _Job] = {}
+        self._last_typing: Dict[int, float] = {}
+        self._metrics_since = time.monotonic()
+
+    def submit(
+        self,
+        bucket: str,
+        priority: Priority,
+        call: Callable[[_Job], Awaitable[Any]],
+        kwargs: Optional[Dict[str, Any]] = None,
+    ) -> _Job:
+        job = _Job(
+            priority=priority,
+            seq=next(self._seq),
+            bucket=bucket,
+            call=call,
+            future=asyncio.get_running_loop().create_future(),
+            kwargs=kwargs or {},
+        )
+        stats = self.stats[bucket]
+        stats.submitted += 1
+        stats.queued += 1
+        heapq.heappush(self._heap, job)
+        self._dispatch()
+        return job
+
+    def _dispatch(self):
+        waiting = []
+        while self._heap and self._in_flight < self.max_concurrent:
+            job = heapq.heappop(self._heap)
+            if job.bucket in self._busy_buckets:
+                waiting.append(job)
+                continue
+            self._busy_buckets.add(job.bucket)
+            self._in_flight += 1
+            task = asyncio.create_task(self._run(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        for job in waiting:
+            heapq.heappush(self._heap, job)
+
+    async def _run(self, job: _Job):
+        # stats are looked up each time, reset_metrics() may swap them mid-call
+        self.stats[job.bucket].queued -= 1
+        job.started = True
+        start = time.monotonic()
+        try:
+            if job.future.done():
+                # every caller gave up on it before it got a turn
+                self.stats[job.bucket].dropped += 1
+                return
+            try:
+                result = await job.call(job)
+            except Exception as e:
+                self.stats[job.bucket].failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                self.stats[job.bucket].completed += 1
+                if not job.future.done():
+                    job.future.set_result(result)
+        finally:
+            self.stats[job.bucket].busy_seconds += time.monotonic() - start
+            self._busy_buckets.discard(job.bucket)
+            self._in_flight -= 1
+            self._dispatch()
+
+    async def send(
+        self, channel: discord.abc.Messageable, priority: Priority, **kwargs
+    ) -> discord.Message:
+        job = self.submit(
+            bucket=f"send:{channel.id}",
+            priority=priority,
+            call=lambda job: channel.send(**job.kwargs),
+            kwargs=kwargs,
+        )
+        return await asyncio.shield(job.future)
+
+    async def edit_thread(
+        self, thread: discord.Thread, priority: Priority = Priority.THREAD, **fields
+    ) -> discord.Thread:
+        # an edit that has not started yet picks up the new fields instead of
+        # queueing a second PATCH for the same thread
+        job = self._pending_edits.get(thread.id)
+        if job is not None and not job.started:
+            job.kwargs.update(fields)
+            self.stats[job.bucket].merged += 1
+            return await asyncio.shield(job.future)
+
+        async def call(job: _Job):
+            self._pending_edits.pop(thread.id, None)
+            return await thread.edit(**job.kwargs)
+
+        job = self.submit(
+            bucket=f"edit:{thread.id}", priority=priority, call=call, kwargs=fields
+        )
+        self._pending_edits[thread.id] = job
+        return await asyncio.shield(job.future)
+
+    async def delete_message(
+        self, message: discord.Message, priority: Priority = Priority.THREAD
+    ):
+        job = self.submit(
+            bucket=f"delete:{message.channel.id}",
+            priority=priority,
+            call=lambda job: message.delete(),
+        )
+        return await asyncio.shield(job.future)
+
+    async def fetch_channel(
+        self, guild: discord.Guild, channel_id: int, priority: Priority
+    ) -> Optional[discord.abc.GuildChannel]:
+        channel = guild.get_channel_or_thread(channel_id)
+        if channel is not None:
+            return channel
+        job = self.submit(
+            bucket=f"fetch_channel:{guild.id}",
+            priority=priority,
+            call=lambda job: guild.fetch_channel(channel_id),
+        )
+        return await asyncio.shield(job.future)
+
+    async def fetch_message(
+        self, channel: discord.abc.Messageable, message_id: int, priority: Priority
+    ) -> discord.Message:
+        job = self.submit(
+            bucket=f"fetch_message:{channel.id}",
+            priority=priority,
+            call=lambda job: channel.fetch_message(message_id),
+        )
+        return await asyncio.shield(job.future)
+
+    async def trigger_typing(self, channel: discord.abc.Messageable):
+        # a typing indicator lasts ~10s, anything sent sooner is redundant
+        now = time.monotonic()
+        bucket = f"typing:{channel.id}"
+        last = self._last_typing.get(channel.id)
+        if last is not None and now - last < SECONDS_BETWEEN_TYPING_CALLS:
+            self.stats[bucket].dropped += 1
+            return
+        self._last_typing[channel.id] = now
+
+        async def call(job: _Job):
+            await channel.typing()
+
+        job = self.submit(bucket=bucket, priority=Priority.THREAD, call=call)
+        try:
+            await asyncio.shield(job.future)
+        except Exception as e:
+            # typing is cosmetic, never fail the reply over it
+            logger.info(f"Typing failed in {channel.id}: {e!r}")
+
+    @asynccontextmanager
+    async def typing(self, channel: discord.abc.Messageable):
+        async def keep_typing():
+            while True:
+                await asyncio.sleep(SECONDS_BETWEEN_TYPING_CALLS)
+                await self.trigger_typing(channel)
+
+        # send the first one before the body runs, like discord.py does, the
+        # completion call blocks the loop so a task would not get a turn
+        await self.trigger_typing(channel)
+        task = asyncio.create_task(keep_typing())
+        try:
+            yield
+        finally:
+            task.cancel()
+
+    async def join(self):
+        # wait for everything queued so far, used when shutting down
+        while self._heap or self._in_flight:
+            await asyncio.sleep(0.05)
+
+    def forget_channel(self, channel_id: int):
+        # queued calls for a channel that is gone are dropped when their turn comes
+        for job in self._heap:
+            if job.bucket.endswith(f":{channel_id}") and not job.future.done():
+                job.future.cancel()
+        self._pending_edits.pop(channel_id, None)
+        self._last_typing.pop(channel_id, None)
+
+    def cache_sizes(self) -> Dict[str, int]:
+        return {
+            "rest_buckets": len(self.stats),
+            "rest_queued": len(self._heap),
+            "typing_channels": len(self._last_typing),
+        }
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        now = time.monotonic()
+        elapsed = max(now - self._metrics_since, 1e-9)
+        result = {}
+        for bucket, stats in self.stats.items():
+            result[bucket] = {
+                "queued": stats.queued,
+                "submitted": stats.submitted,
+                "completed": stats.completed,
+                "failed": stats.failed,
+                "merged": stats.merged,
+                "dropped": stats.dropped,
+                "utilization": round(stats.busy_seconds / elapsed, 3),
+            }
+        return result
+
+    def reset_metrics(self):
+        self._metrics_since = time.monotonic()
+        # drop idle buckets so the stats do not grow with every channel ever seen
+        self.stats = defaultdict(
+            BucketStats,
+            {
+                bucket: BucketStats(queued=stats.queued)
+                for bucket, stats in self.stats.items()
+                if stats.queued > 0 or bucket in self._busy_buckets
+            },
+        )
+
+
+scheduler = RestScheduler()
+
+
+async def log_rest_metrics(interval: float = SECONDS_BETWEEN_REST_METRICS):
+    while True:
+        await asyncio.sleep(interval)
+        metrics = scheduler.metrics()
+        scheduler.reset_metrics()
+        if not metrics:
+            continue
+        busiest = sorted(
+            metrics.items(), key=lambda item: item[1]["utilization"], reverse=True
+        )
+        total = {
+            key: sum(m[key] for m in metrics.values())
+            for key in (
+                "queued",
+                "submitted",
+                "completed",
+                "failed",
+                "merged",
+                "dropped",
+            )
+        }
+        logger.info(f"REST buckets: {len(metrics)} {total}")
+        for bucket, m in busiest[:5]:
+            logger.info(f"REST bucket {bucket}: {m}")
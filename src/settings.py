@@ -0,0 +1,143 @@
+from dataclasses import dataclass
+import asyncio
+import logging
+import os
+import dacite
+import yaml
+from dotenv import dotenv_values, find_dotenv
+from typing import Callable, Dict, FrozenSet, List, Mapping, Optional, Tuple
+from src.base import Config
+from src.constants import (
+    SCRIPT_DIR,
+    PROCESS_ENV,
+    MODERATION_VALUES_FOR_BLOCKED,
+    MODERATION_VALUES_FOR_FLAGGED,
+    SECONDS_BETWEEN_SETTINGS_CHECKS,
+)
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = os.path.join(SCRIPT_DIR, "config.yaml")
+
+
+@dataclass(frozen=True)
+class Settings:
+    config: Config
+    allowed_server_ids: FrozenSet[int]
+    server_to_moderation_channel: Mapping[int, int]
+    moderation_values_for_blocked: Mapping[str, float]
+    moderation_values_for_flagged: Mapping[str, float]
+
+
+def parse_server_ids(value: str) -> FrozenSet[int]:
+    return frozenset(int(s) for s in value.split(",") if s.strip())
+
+
+def parse_server_to_moderation_channel(value: str) -> Dict[int, int]:
+    result: Dict[int, int] = {}
+    for s in value.split(","):
+        if not s.strip():
+            continue
+        server_id, channel_id = s.split(":")
+        result[int(server_id)] = int(channel_id)
+    return result
+
+
+def merge_moderation_values(
+    defaults: Dict[str, float], overrides: Optional[Dict[str, float]]
+) -> Dict[str, float]:
+    values = {**defaults, **(overrides or {})}
+    for category, value in values.items():
+        if not 0.0 <= value <= 1.0:
+            raise ValueError(f"moderation value for {category} must be in [0, 1]")
+    return values
+
+
+def read_env() -> Dict[str, str]:
+    # values from the real environment win over .env, same as load_dotenv()
+    dotenv_path = find_dotenv()
+    values = dotenv_values(dotenv_path) if dotenv_path else {}
+    return {**{k: v for k, v in values.items() if v is not None}, **PROCESS_ENV}
+
+
+def load_settings() -> Settings:
+    # everything is parsed before anything is swapped in, so a bad edit raises
+    # here and the running settings are left untouched
+    with open(CONFIG_PATH, "r") as f:
+        config = dacite.from_dict(Config, yaml.safe_load(f))
+    if not config.name or not config.instructions:
+        raise ValueError("config.yaml needs a name and instructions")
+
+    env = read_env()
+    allowed_server_ids = parse_server_ids(env["ALLOWED_SERVER_IDS"])
+    if not allowed_server_ids:
+        raise ValueError("ALLOWED_SERVER_IDS is empty")
+
+    return Settings(
+        config=config,
+        allowed_server_ids=allowed_server_ids,
+        server_to_moderation_channel=parse_server_to_moderation_channel(
+            env.get("SERVER_TO_MODERATION_CHANNEL", "")
+        ),
+        moderation_values_for_blocked=merge_moderation_values(
+            MODERATION_VALUES_FOR_BLOCKED, config.moderation_values_for_blocked
+        ),
+        moderation_values_for_flagged=merge_moderation_values(
+            MODERATION_VALUES_FOR_FLAGGED, config.moderation_values_for_flagged
+        ),
+    )
+
+
+_settings: Settings = load_settings()
+_reload_listeners: List[Callable[[Settings, Settings], None]] = []
+
+
+def current() -> Settings:
+    return _settings
+
+
+def add_reload_listener(listener: Callable[[Settings, Settings], None]):
+    """Called with (old, new) after new settings are swapped in. Use it to drop
+    caches derived from the settings, everything else stays warm."""
+    _reload_listeners.append(listener)
+
+
+def reload_settings() -> bool:
+    global _settings
+    try:
+        new_settings = load_settings()
+    except Exception as e:
+        logger.warning(f"Keeping current settings, failed to reload: {e!r}")
+        return False
+
+    old_settings = _settings
+    if new_settings == old_settings:
+        return False
+    _settings = new_settings
+    logger.info("Settings reloaded")
+    for listener in _reload_listeners:
+        try:
+            listener(old_settings, new_settings)
+        except Exception as e:
+            logger.exception(e)
+    return True
+
+
+def _watched_mtimes() -> Tuple[Optional[float], ...]:
+    mtimes = []
+    for path in (CONFIG_PATH, find_dotenv()):
+        try:
+            mtimes.append(os.stat(path).st_mtime if path else None)
+        except OSError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+
+async def watch_settings(interval: float = SECONDS_BETWEEN_SETTINGS_CHECKS):
+    last_mtimes = _watched_mtimes()
+    while True:
+        await asyncio.sleep(interval)
+        mtimes = _watched_mtimes()
+        if mtimes != last_mtimes:
+            last_mtimes = mtimes
+            reload_settings()
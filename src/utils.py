@@ -1,14 +1,18 @@
-from src.constants import (
-    ALLOWED_SERVER_IDS,
-)
+from src import settings
 import logging
 import io
 from src.base import Message
+from src.rest import scheduler, Priority
+from src.lifecycle import tracker
 from discord import Message as DiscordMessage
 from typing import List, Optional, Tuple
 import discord
 
-from src.constants import MAX_CHARS_PER_REPLY_MSG, INACTIVATE_THREAD_PREFIX
+from src.constants import (
+    MAX_CHARS_PER_REPLY_MSG,
+    INACTIVATE_THREAD_PREFIX,
+    MAX_THREAD_MESSAGES,
+)
 
 logging.basicConfig(
     format="[%(asctime)s] [%(filename)s:%(lineno)d] %(message)s", level=logging.INFO
@@ -22,9 +26,13 @@ async def discord_message_to_message(message: DiscordMessage) -> Optional[Messag
     ):
         original_message = message.reference.cached_message
         if not original_message:
-            channel = await message.guild.fetch_channel(message.reference.channel_id)
+            channel = await scheduler.fetch_channel(
+                message.guild, message.reference.channel_id, Priority.REPLY
+            )
             if channel:
-                original_message = await channel.fetch_message(message.reference.message_id)
+                original_message = await scheduler.fetch_message(
+                    channel, message.reference.message_id, Priority.REPLY
+                )
 
         if len(original_message.embeds) > 0 and len(original_message.embeds[0].fields) > 0:
             field = original_message.embeds[0].fields[0]
@@ -44,26 +52,49 @@ def split_into_shorter_messages(message: str) -> List[str]:
     ]
 
 
+async def thread_history(thread: discord.Thread) -> List[Message]:
+    # oldest first, what the model is given
+    messages = [
+        await discord_message_to_message(message)
+        async for message in thread.history(limit=MAX_THREAD_MESSAGES)
+    ]
+    messages = [x for x in messages if x is not None]
+    messages.reverse()
+    return messages
+
+
 def is_last_message_stale(
-    interaction_message: DiscordMessage, last_message: DiscordMessage, bot_id: str
+    interaction_message: Optional[DiscordMessage],
+    last_message: DiscordMessage,
+    bot_id: str,
 ) -> bool:
     return (
         last_message
-        and last_message.id != interaction_message.id
+        and (interaction_message is None or last_message.id != interaction_message.id)
         and last_message.author
         and last_message.author.id != bot_id
     )
 
 
 async def close_thread(thread: discord.Thread):
-    await thread.edit(name=INACTIVATE_THREAD_PREFIX)
-    await thread.send(
+    # send first, so the rename, archive and lock can go out as a single edit
+    await scheduler.send(
+        thread,
+        Priority.REPLY,
         embed=discord.Embed(
             description="**Thread closed** - Context limit reached, closing...",
             color=discord.Color.blue(),
-        )
+        ),
     )
-    await thread.edit(archived=True, locked=True)
+    tracker.mark_closing(thread.id)
+    try:
+        await scheduler.edit_thread(
+            thread, name=INACTIVATE_THREAD_PREFIX, archived=True, locked=True
+        )
+    except BaseException:
+        # still open, an archive by anyone else cancels its work as usual
+        tracker.unmark_closing(thread.id)
+        raise
 
 
 def should_block(guild: Optional[discord.Guild]) -> bool:
@@ -72,7 +103,7 @@ def should_block(guild: Optional[discord.Guild]) -> bool:
         logger.info(f"DM not supported")
         return True
 
-    if guild.id and guild.id not in ALLOWED_SERVER_IDS:
+    if guild.id and guild.id not in settings.current().allowed_server_ids:
         # not allowed in this server
         logger.info(f"Guild {guild} not allowed")
         return True